@@ -1,178 +1,394 @@
-import requests
-import json
-import csv
+import requests_cache
+import orjson
+import re
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from urllib3.util.retry import Retry
+
+# Shared session so every ChEMBL call reuses pooled keep-alive connections.
+# Responses are also cached on disk (chembl_cache.sqlite) for a day, since
+# ChEMBL records don't change between runs of the pipeline.
+_SESSION = requests_cache.CachedSession(
+    "chembl_cache",
+    backend="sqlite",
+    expire_after=24 * 3600,
+    allowable_methods=("GET",),
+)
+# Transient errors and rate limiting are retried with backoff (honouring Retry-After);
+# once retries run out the last response is returned, so callers' status checks still apply
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    ),
+))
+
+# Upper bound on concurrent requests to ChEMBL, to stay polite to the EBI servers
+_MAX_WORKERS = 16
+_REQUEST_SLOTS = threading.BoundedSemaphore(_MAX_WORKERS)
+
+# (connect, read) seconds, so a stalled ChEMBL connection can't hang the pipeline
+_TIMEOUT = (5, 30)
+# drug_indication pages (up to 1000 rows) can take ChEMBL longer to produce
+_INDICATION_TIMEOUT = (5, 60)
+
+def _get(url, params=None, timeout=_TIMEOUT):
+    """
+    GET through the shared session, limited to _MAX_WORKERS requests in flight.
+    Returns None if the request itself fails (e.g. a timeout or connection error
+    that outlasted the retries), so callers treat it like any other failed lookup.
+    """
+    with _REQUEST_SLOTS:
+        try:
+            return _SESSION.get(url, params=params, timeout=timeout)
+        except RequestException as e:
+            print(f"[WARN] Request failed for {url}: {e}")
+            return None
+
+def _json(resp):
+    """
+    Decodes a response body with orjson, which is much faster than resp.json() on the large ChEMBL payloads.
+    """
+    return orjson.loads(resp.content)
+
+def _first_molecule_id(base, params_list):
+    """
+    Runs the molecule searches in params_list concurrently and returns the ChEMBL ID
+    from the first search in params_list order that finds a molecule, so earlier
+    searches (e.g. pref_name) always win over later ones (e.g. synonyms).
+    Returns as soon as that search is known to win, without waiting for the
+    lower-priority ones. Returns None if none of them match.
+    """
+    ex = ThreadPoolExecutor(max_workers=len(params_list))
+    try:
+        futures = [ex.submit(_get, base, params) for params in params_list]
+        for fut in futures:
+            resp = fut.result()
+            if resp is not None and resp.status_code == 200:
+                molecules = _json(resp).get("molecules", [])
+                if molecules:
+                    return molecules[0]["molecule_chembl_id"]
+        return None
+    finally:
+        # Don't block on the remaining searches once a higher-priority one has matched
+        ex.shutdown(wait=False)
 
 def get_chembl_id_exact(drug_name):
     """
     Attempts to find the best ChEMBL ID for a drug name.
     First tries exact matches (preferred name and synonyms).
     If no exact match is found, tries partial matches.
-    Returns a list with the first matching ChEMBL ID, or an empty list if not found.
+    Returns a tuple with the first matching ChEMBL ID, or an empty tuple if not found
+    (hashable, so callers can memoize on it).
     """
     base = "https://www.ebi.ac.uk/chembl/api/data/molecule.json"
+    # Synonyms are matched on molecule_synonyms__molecule_synonym only; the
+    # `synonym` variant filtered the same nested records a second time.
+    # Only the first hit's ID is used, so ask for just that field of one row.
     # 1. Try exact matches
     params_list = [
         {"pref_name__iexact": drug_name},
-        {"molecule_synonyms__synonym__iexact": drug_name},
         {"molecule_synonyms__molecule_synonym__iexact": drug_name},
     ]
     for params in params_list:
-        params.update({"limit": 200, "offset": 0})
-        resp = requests.get(base, params=params)
-        if resp.status_code == 200:
-            molecules = resp.json().get("molecules", [])
-            if molecules:
-                chembl_id = molecules[0]["molecule_chembl_id"]
-                return [chembl_id]
-    # 2. If no exact match, try partial matches
+        params.update({"limit": 1, "only": "molecule_chembl_id"})
+    chembl_id = _first_molecule_id(base, params_list)
+    if chembl_id:
+        return (chembl_id,)
+    # 2. Only if no exact match, try partial matches
     params_list_partial = [
         {"pref_name__icontains": drug_name},
-        {"molecule_synonyms__synonym__icontains": drug_name},
         {"molecule_synonyms__molecule_synonym__icontains": drug_name},
     ]
     for params in params_list_partial:
-        params.update({"limit": 200, "offset": 0})
-        resp = requests.get(base, params=params)
-        if resp.status_code == 200:
-            molecules = resp.json().get("molecules", [])
-            if molecules:
-                chembl_id = molecules[0]["molecule_chembl_id"]
-                return [chembl_id]
-    return []
-
-def fetch_molecule_type(chembl_id):
-    """
-    Given a ChEMBL ID, fetches the molecule type (e.g., 'Small molecule', 'Protein').
-    Returns 'NA' if not found or on error.
-    """
-    url = f"https://www.ebi.ac.uk/chembl/api/data/molecule/{chembl_id}.json"
-    resp = requests.get(url)
-    if resp.status_code == 200:
-        return resp.json().get("molecule_type", "NA")
-    else:
-        print(f"[WARN] Failed to fetch molecule type ({resp.status_code}) for {chembl_id}")
-        return "NA"
+        params.update({"limit": 1, "only": "molecule_chembl_id"})
+    chembl_id = _first_molecule_id(base, params_list_partial)
+    if chembl_id:
+        return (chembl_id,)
+    return ()
 
-def fetch_approval_status(chembl_id, disease_name):
+def fetch_molecule_types(chembl_ids):
     """
-    Checks if a drug (by ChEMBL ID) is approved for a given disease/indication.
-    Returns 'Approved' if max_phase_for_ind is 4 for the indication,
-    'Not Approved' if found but not phase 4, or 'NA' if not found.
+    For a list of ChEMBL IDs, fetches the molecule types (e.g., 'Small molecule', 'Protein')
+    with batched molecule_chembl_id__in queries (100 IDs each, run concurrently).
+    Returns a dict of chembl_id -> molecule type ('NA' for IDs that were not found
+    or whose request failed).
+    """
+    unique_ids = list(dict.fromkeys(cid for cid in chembl_ids if cid))
+    types = {cid: "NA" for cid in unique_ids}
+
+    def fetch_chunk(chunk):
+        return _get_all_pages(
+            "https://www.ebi.ac.uk/chembl/api/data/molecule.json",
+            {"molecule_chembl_id__in": ",".join(chunk), "limit": 1000, "offset": 0,
+             "only": "molecule_chembl_id,molecule_type"},
+            "molecules",
+        ) or []
+
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as ex:
+        for chunk in ex.map(fetch_chunk, _chunks(unique_ids, 100)):
+            for mol in chunk:
+                if mol.get("molecule_chembl_id") in types:
+                    types[mol["molecule_chembl_id"]] = mol.get("molecule_type") or "NA"
+    return types
+
+# The only drug_indication fields the approval check reads; projecting to them
+# keeps the (up to 1000-row) indication payloads small to download and parse
+_INDICATION_FIELDS = "molecule_chembl_id,efo_term,mesh_heading,indication_refs,max_phase_for_ind"
+
+def fetch_approval_statuses(chembl_ids, disease_name):
+    """
+    Checks whether drugs (by ChEMBL ID) are approved for a given disease/indication.
+    Fetches the indications of many drugs with molecule_chembl_id__in queries
+    (100 IDs each, run concurrently) instead of one request per drug.
+    Returns a dict of chembl_id -> 'Approved' if any matching indication has
+    max_phase_for_ind 4, 'Not Approved' otherwise, or 'NA' if the indications
+    could not be fetched.
+    """
+    unique_ids = list(dict.fromkeys(cid for cid in chembl_ids if cid))
+
+    def fetch_chunk(chunk):
+        indications = _get_all_pages(
+            "https://www.ebi.ac.uk/chembl/api/data/drug_indication.json",
+            {"molecule_chembl_id__in": ",".join(chunk), "limit": 1000, "offset": 0, "only": _INDICATION_FIELDS},
+            "drug_indications",
+            timeout=_INDICATION_TIMEOUT,
+        )
+        if indications is None:
+            return {cid: "NA" for cid in chunk}
+        grouped = {cid: [] for cid in chunk}
+        for ind in indications:
+            grouped.setdefault(ind.get("molecule_chembl_id"), []).append(ind)
+        return {cid: _approval_from_indications(cid, grouped[cid], disease_name) for cid in chunk}
+
+    statuses = {}
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as ex:
+        for chunk_statuses in ex.map(fetch_chunk, _chunks(unique_ids, 100)):
+            statuses.update(chunk_statuses)
+    return statuses
+
+def _approval_from_indications(chembl_id, indications, disease_name):
+    """
+    Derives the approval status of a drug for disease_name from its drug_indication rows.
     """
-    url = f"https://www.ebi.ac.uk/chembl/api/data/drug_indication.json?molecule_chembl_id={chembl_id}&limit=1000"
-    resp = requests.get(url)
-    
-    if resp.status_code != 200:
-        print(f"[WARN] Failed to fetch drug indication ({resp.status_code}) for {chembl_id}")
-        return "NA"
-    
-    indications = resp.json().get("drug_indications", [])
     if not indications:
         print(f"[INFO] No indications found for {chembl_id}")
         return "Not Approved"
 
-    # Normalize disease name for comparison
-    disease_terms = set(word.lower() for word in disease_name.split())
-    
+    # Normalize disease name once for comparison; an indication matches when at
+    # least half of the disease's words appear in it
+    disease_terms = frozenset(disease_name.lower().split())
+    needed = (len(disease_terms) + 1) // 2
+
+    found_any = False
     for ind in indications:
+        is_phase4 = _phase_of(ind) == 4
+        # Once a non-approved match is known, only phase-4 indications can change the answer
+        if found_any and not is_phase4:
+            continue
+
         # Get all possible indication texts
-        ind_texts = []
-        if ind.get("efo_term"):
-            ind_texts.append(ind.get("efo_term"))
-        if ind.get("mesh_heading"):
-            ind_texts.append(ind.get("mesh_heading"))
-        if ind.get("indication_refs"):
-            for ref in ind.get("indication_refs", []):
-                if ref.get("ref_text"):
-                    ind_texts.append(ref.get("ref_text"))
+        ind_texts = [ind.get("efo_term"), ind.get("mesh_heading")]
+        for ref in ind.get("indication_refs") or []:
+            ind_texts.append(ref.get("ref_text"))
 
         # Check each indication text for match
         for text in ind_texts:
             if not text:
                 continue
-                
-            # Convert indication text to set of words for partial matching
-            ind_terms = set(word.lower() for word in text.split())
-            
-            # Check if enough terms match (at least 50% overlap)
-            common_terms = disease_terms.intersection(ind_terms)
-            if len(common_terms) >= len(disease_terms) / 2:
-                phase = float(ind.get("max_phase_for_ind", 0))
-                if phase == 4:
+
+            if _enough_terms_match(text, disease_terms, needed):
+                if is_phase4:
                     return "Approved"
-                else:
-                    return "Not Approved"
-    
-    print(f"[INFO] No matching indications found for {chembl_id} and disease '{disease_name}'")
+                found_any = True
+                break
+
+    if not found_any:
+        print(f"[INFO] No matching indications found for {chembl_id} and disease '{disease_name}'")
     return "Not Approved"
 
+def _enough_terms_match(text, disease_terms, needed):
+    """
+    True once `needed` distinct disease terms have been seen among the words of text.
+    """
+    if needed == 0:
+        return True
+    hits = set()
+    for word in text.lower().split():
+        if word in disease_terms:
+            hits.add(word)
+            if len(hits) >= needed:
+                return True
+    return False
+
+def _phase_of(ind):
+    """
+    Returns max_phase_for_ind as an int (ChEMBL serves it as e.g. "4.0"), or 0 if missing.
+    """
+    try:
+        return int(float(ind.get("max_phase_for_ind") or 0))
+    except (TypeError, ValueError):
+        return 0
+
+def _chunks(items, size):
+    """
+    Yields successive slices of at most `size` items.
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _get_all_pages(url, params, key, timeout=_TIMEOUT):
+    """
+    GETs a ChEMBL list endpoint and follows page_meta.next until exhausted.
+    Returns the concatenated `key` rows, or None if any page failed.
+    """
+    rows = []
+    while url:
+        resp = _get(url, params=params, timeout=timeout)
+        if resp is None:
+            return None
+        if resp.status_code != 200:
+            print(f"[WARN] {key} fetch failed ({resp.status_code}) for {url}")
+            return None
+        payload = _json(resp)
+        rows.extend(payload.get(key, []))
+        next_page = (payload.get("page_meta") or {}).get("next")
+        # `next` is a path that already carries the filters
+        url = f"https://www.ebi.ac.uk{next_page}" if next_page else None
+        params = None
+    return rows
+
+def _fetch_mechanisms(chembl_ids):
+    """
+    Fetches mechanism rows for a batch of ChEMBL IDs with a single
+    molecule_chembl_id__in query. Returns a dict of chembl_id -> mechanism rows,
+    or None if the request failed.
+    """
+    mechanisms = _get_all_pages(
+        "https://www.ebi.ac.uk/chembl/api/data/mechanism.json",
+        {"molecule_chembl_id__in": ",".join(chembl_ids), "limit": 1000, "offset": 0,
+         "only": "molecule_chembl_id,mechanism_of_action,target_chembl_id"},
+        "mechanisms",
+    )
+    if mechanisms is None:
+        return None
+    grouped = {}
+    for mech in mechanisms:
+        grouped.setdefault(mech.get("molecule_chembl_id"), []).append(mech)
+    return grouped
+
+def _fetch_activity_target_id(chembl_id):
+    """
+    Returns the target_chembl_id of the first activity recorded for a ChEMBL ID, or None.
+    """
+    act_url = f"https://www.ebi.ac.uk/chembl/api/data/activity.json?molecule_chembl_id={chembl_id}&limit=1"
+    act_resp = _get(act_url)
+    if act_resp is not None and act_resp.status_code == 200:
+        activities = _json(act_resp).get("activities", [])
+        if activities:
+            return activities[0].get("target_chembl_id")
+    return None
+
 def fetch_moa_targets_for_ids(chembl_ids):
     """
     For a list of ChEMBL IDs, fetches mechanism of action (MoA) and target information.
     Returns a list of tuples: (chembl_id, mechanism_of_action, target_name, target_id).
     If no mechanism is found, tries to get the first target_chembl_id from the activity endpoint as a fallback.
+    Mechanisms and target names are both fetched in batches of up to 100 IDs; target
+    records already fetched in this run are reused from _TARGET_RECORDS.
     """
-    mechanisms = []
-    for chembl_id in chembl_ids:
-        mech_url = (
-            "https://www.ebi.ac.uk/chembl/api/data/mechanism.json"
-            f"?molecule_chembl_id={chembl_id}&limit=1000&offset=0"
-        )
-        resp = requests.get(mech_url)
-        found_mechanism = False
-        if resp.status_code == 200:
-            for mech in resp.json().get("mechanisms", []):
-                moa = mech.get("mechanism_of_action") or "NA"
-                tgt_id = mech.get("target_chembl_id")
-                tgt_name = fetch_target_name(tgt_id) if tgt_id else "NA"
-                mechanisms.append((chembl_id, moa, tgt_name, tgt_id))
-                found_mechanism = True
-        else:
-            print(f"[WARN] Mechanism fetch failed ({resp.status_code}) for {chembl_id}")
+    chembl_ids = list(chembl_ids)
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as ex:
+        # ~100 IDs per request keeps the URL well under server limits
+        mech_by_id = {}
+        for grouped in ex.map(_fetch_mechanisms, _chunks(chembl_ids, 100)):
+            mech_by_id.update(grouped or {})
+        mech_results = [mech_by_id.get(cid) for cid in chembl_ids]
 
         # Fallback: If no mechanism found, try activity endpoint for target_chembl_id
-        if not found_mechanism:
-            act_url = f"https://www.ebi.ac.uk/chembl/api/data/activity.json?molecule_chembl_id={chembl_id}&limit=1"
-            act_resp = requests.get(act_url)
-            if act_resp.status_code == 200:
-                activities = act_resp.json().get("activities", [])
-                if activities:
-                    tgt_id = activities[0].get("target_chembl_id")
-                    tgt_name = fetch_target_name(tgt_id) if tgt_id else "NA"
-                    mechanisms.append((chembl_id, "NA", tgt_name, tgt_id))
-    return mechanisms
-
-def fetch_target_name(target_chembl_id):
-    """
-    Given a ChEMBL target ID, fetches the gene symbol (GENE_SYMBOL) for the target.
-    Falls back to the preferred name if no gene symbol is found.
-    Returns 'NA' if not found or on error.
-    """
-    url = f"https://www.ebi.ac.uk/chembl/api/data/target/{target_chembl_id}.json"
-    resp = requests.get(url)
-    if resp.status_code == 200:
-        target = resp.json()
-        # Search for GENE_SYMBOL in target_components
-        for comp in target.get("target_components", []):
-            for syn in comp.get("target_component_synonyms", []):
-                if syn.get("syn_type") == "GENE_SYMBOL":
-                    return syn.get("component_synonym", "NA")
-        # Fallback to pref_name
-        return target.get("pref_name", "NA")
-    else:
-        print(f"[WARN] Failed to fetch target name ({resp.status_code}) for {target_chembl_id}")
-        return "NA"
+        fallback_ids = [cid for cid, mechs in zip(chembl_ids, mech_results) if not mechs]
+        fallback_targets = dict(zip(fallback_ids, ex.map(_fetch_activity_target_id, fallback_ids)))
+
+        # (chembl_id, moa, target_id) triples, in the same order as the serial version
+        triples = []
+        for chembl_id, mechs in zip(chembl_ids, mech_results):
+            if mechs:
+                for mech in mechs:
+                    triples.append((chembl_id, mech.get("mechanism_of_action") or "NA", mech.get("target_chembl_id")))
+            elif fallback_targets.get(chembl_id):
+                triples.append((chembl_id, "NA", fallback_targets[chembl_id]))
 
+    unique_tids = list(dict.fromkeys(tid for _, _, tid in triples if tid))
+    name_map = {tid: _gene_symbol(target) for tid, target in _fetch_targets(unique_tids).items()}
+
+    return [(chembl_id, moa, name_map.get(tgt_id, "NA"), tgt_id) for chembl_id, moa, tgt_id in triples]
+
+# Target records fetched so far in this run, keyed by target_chembl_id
+_TARGET_RECORDS = {}
+
+def _fetch_targets(target_chembl_ids):
+    """
+    Fetches target records for many target IDs with batched target_chembl_id__in
+    queries (100 IDs each, run concurrently). Returns a dict of target_chembl_id -> record;
+    IDs that could not be fetched are missing from the dict.
+    Records already fetched in this run are served from _TARGET_RECORDS.
+    """
+    target_chembl_ids = list(dict.fromkeys(tid for tid in target_chembl_ids if tid))
+    missing = [tid for tid in target_chembl_ids if tid not in _TARGET_RECORDS]
+
+    def fetch_chunk(chunk):
+        return _get_all_pages(
+            "https://www.ebi.ac.uk/chembl/api/data/target.json",
+            {"target_chembl_id__in": ",".join(chunk), "limit": 1000, "offset": 0,
+             "only": "target_chembl_id,pref_name,target_type,target_components"},
+            "targets",
+        ) or []
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as ex:
+            for chunk in ex.map(fetch_chunk, _chunks(missing, 100)):
+                for target in chunk:
+                    _TARGET_RECORDS[target["target_chembl_id"]] = target
+    return {tid: _TARGET_RECORDS[tid] for tid in target_chembl_ids if tid in _TARGET_RECORDS}
+
+def _gene_symbol(target):
+    """
+    Returns the GENE_SYMBOL of a target record, falling back to its preferred name.
+    """
+    # Search for GENE_SYMBOL in target_components
+    for comp in target.get("target_components", []):
+        for syn in comp.get("target_component_synonyms", []):
+            if syn.get("syn_type") == "GENE_SYMBOL":
+                return syn.get("component_synonym", "NA")
+    # Fallback to pref_name
+    return target.get("pref_name", "NA")
+
+# Word-start anchor keeps "antagonist" from being reported as "agonist"
+_MOA_RE = re.compile(r"\b(inhibitor|agonist|antagonist|modulator|blocker|activator)", re.IGNORECASE)
+
+# The same MoA strings (e.g. "Cyclooxygenase inhibitor") recur across many drugs
+@lru_cache(maxsize=4096)
 def extract_moa_keyword(moa):
     """
     Extracts a short keyword from the MoA string (e.g., 'inhibitor', 'agonist').
     If a known keyword is found, returns it; otherwise, returns the last word or 'NA'.
     """
-    for kw in ["inhibitor", "agonist", "antagonist", "modulator", "blocker", "activator"]:
-        if kw in moa.lower():
-            return kw
+    if not moa:
+        return "NA"
+    m = _MOA_RE.search(moa)
+    if m:
+        return m.group(1).lower()
     # fallback: last word
-    return moa.split()[-1] if moa else "NA"
+    return moa.split()[-1]
 
 def get_moa_short(moa_targets):
     """
@@ -197,18 +413,25 @@ def format_multi_drug_output(blocks):
     """
     return " | ".join([", ".join([v for v in vals if v and v != "NA"]) if vals else "NA" for vals in blocks])
 
-def get_target_type(target_id):
+def clear_caches(persistent=False):
     """
-    Given a target ID, fetches the target type (e.g., 'SINGLE PROTEIN', 'MULTI-PROTEIN').
-    Returns 'NA' if not found or on error.
+    Clears the in-process lookup caches of this module (e.g. between tests).
+    With persistent=True, also empties the on-disk ChEMBL response cache.
     """
-    url = f"https://www.ebi.ac.uk/chembl/api/data/target/{target_id}.json"
-    resp = requests.get(url)
-    if resp.status_code == 200:
-        return resp.json().get("target_type", "NA")
-    else:
-        print(f"[WARN] Failed to fetch target type ({resp.status_code}) for {target_id}")
-        return "NA"
+    extract_moa_keyword.cache_clear()
+    _TARGET_RECORDS.clear()
+    if persistent:
+        _SESSION.cache.clear()
+
+def get_target_types(target_ids):
+    """
+    Returns a dict of target_id -> target type (e.g., 'SINGLE PROTEIN', 'MULTI-PROTEIN')
+    for the distinct IDs given, reusing target records already fetched for the mechanisms.
+    IDs that could not be fetched map to 'NA'.
+    """
+    targets = _fetch_targets(target_ids)
+    return {tid: targets[tid].get("target_type", "NA") if tid in targets else "NA"
+            for tid in target_ids if tid}
 
 
 
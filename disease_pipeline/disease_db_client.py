@@ -1,96 +1,190 @@
 import os
-import psycopg2
+import threading
+import uuid
+from contextlib import contextmanager
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import RealDictCursor
 from dotenv import load_dotenv
 from mesh_mapping import get_mesh_term_for_disease
 import logging
 
 load_dotenv()
 
+# Built once at import; fetch_data only binds the array of disease/MeSH names
+# (the same array to both branches) and the page bounds: a NULL after_nct_id,
+# limit or offset leaves that bound off. The bounds count distinct trials, not
+# rows. {op} is "=" for exact matching or "LIKE" for prefix matching. Drug names
+# and intervention types come back as deduplicated arrays and are joined
+# client-side; UNION already removes duplicate rows, so no outer DISTINCT is needed.
+TRIALS_QUERY = """
+WITH all_trials AS (
+    -- Trials whose listed condition matches either name
+    SELECT
+        s.nct_id,
+        c.downcase_name AS condition_name,
+        s.phase,
+        s.overall_status,
+        s.source AS sponsor,
+        s.source_class,
+        s.official_title,
+        array_agg(DISTINCT i.name) AS drug_names,
+        array_agg(DISTINCT i.intervention_type) AS intervention_types
+    FROM
+        ctgov.conditions c
+    JOIN
+        ctgov.studies s ON c.nct_id = s.nct_id
+    JOIN
+        ctgov.interventions i ON s.nct_id = i.nct_id
+    WHERE
+        c.downcase_name {op} ANY(%s)
+        AND s.study_type = 'INTERVENTIONAL'
+        AND i.intervention_type IN ('DRUG', 'BIOLOGICAL')
+    GROUP BY
+        s.nct_id, c.downcase_name, s.phase, s.overall_status, s.source, s.source_class, s.official_title
+
+    UNION
+
+    -- Trials whose MeSH-browsed condition matches either name
+    SELECT
+        s.nct_id,
+        bc.downcase_mesh_term AS condition_name,
+        s.phase,
+        s.overall_status,
+        s.source AS sponsor,
+        s.source_class,
+        s.official_title,
+        array_agg(DISTINCT i.name) AS drug_names,
+        array_agg(DISTINCT i.intervention_type) AS intervention_types
+    FROM
+        ctgov.browse_conditions bc
+    JOIN
+        ctgov.studies s ON bc.nct_id = s.nct_id
+    JOIN
+        ctgov.interventions i ON s.nct_id = i.nct_id
+    WHERE
+        bc.downcase_mesh_term {op} ANY(%s)
+        AND s.study_type = 'INTERVENTIONAL'
+        AND i.intervention_type IN ('DRUG', 'BIOLOGICAL')
+    GROUP BY
+        s.nct_id, bc.downcase_mesh_term, s.phase, s.overall_status, s.source, s.source_class, s.official_title
+),
+-- Pages count whole trials, so a trial's condition rows never straddle two pages
+page AS (
+    SELECT DISTINCT nct_id FROM all_trials
+    WHERE %s::text IS NULL OR nct_id > %s
+    ORDER BY nct_id
+    LIMIT %s OFFSET %s
+)
+SELECT * FROM all_trials
+WHERE nct_id IN (SELECT nct_id FROM page)
+ORDER BY nct_id, condition_name;
+"""
+
+_TRIALS_QUERIES = {
+    "exact": TRIALS_QUERY.format(op="="),
+    "prefix": TRIALS_QUERY.format(op="LIKE"),
+}
+
+def _like_prefix(term):
+    """
+    Escapes LIKE wildcards in term and turns it into a prefix pattern.
+    """
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped + "%"
+
 class DBClient:
+    # Shared by every DBClient so warm connections are reused across instances and threads
+    _pool = None
+    _pool_lock = threading.Lock()
+
     def __init__(self):
         self.host = os.getenv("db_host")
         self.port = os.getenv("db_port")
         self.userid = os.getenv("db_userid")
         self.pwd = os.getenv("db_password")
-        self.connection = self.connect_to_db()
+        self._pool = self.connect_to_db()
 
     def connect_to_db(self):
-        return psycopg2.connect(
-            host=self.host,
-            port=self.port,
-            user=self.userid,
-            password=self.pwd,
-            dbname="aact_db"  # Updated to correct DB name
-        )
-
-    def fetch_data(self, disease_name):
+        with DBClient._pool_lock:
+            if DBClient._pool is None:
+                DBClient._pool = ThreadedConnectionPool(
+                    2, 16,
+                    host=self.host,
+                    port=self.port,
+                    user=self.userid,
+                    password=self.pwd,
+                    dbname="aact_db"  # Updated to correct DB name
+                )
+        return DBClient._pool
+
+    @contextmanager
+    def _acquire(self):
+        """
+        Borrows a connection from the pool and returns it when done.
+        """
+        conn = self._pool.getconn()
+        try:
+            yield conn
+        finally:
+            self._pool.putconn(conn)
+
+    def fetch_data(self, disease_name, match="exact", limit=None, offset=None, after_nct_id=None):
         """
         Fetches clinical trial data for both the original disease name (name 1)
         and its MeSH term (name 2), merging results automatically for any disease.
+        match="prefix" returns conditions that start with either name instead of
+        equalling it (see README for the index that keeps this fast).
+        Rows are ordered by nct_id; limit/offset page through trials (all of a
+        trial's condition rows land on the same page) in SQL, and after_nct_id
+        starts after that trial (keyset paging, which stays fast at large offsets).
+        Returns a list of row dicts; use iter_data to stream them instead.
+        """
+        return list(self.iter_data(disease_name, match=match, limit=limit, offset=offset,
+                                   after_nct_id=after_nct_id))
+
+    def iter_data(self, disease_name, match="exact", limit=None, offset=None, after_nct_id=None):
         """
+        Generator version of fetch_data: yields row dicts as Postgres streams them,
+        so memory stays at one page (itersize rows) regardless of result size.
+        The pooled connection is held until the generator is exhausted or closed.
+        """
+        if match not in _TRIALS_QUERIES:
+            raise ValueError(f"match must be one of {sorted(_TRIALS_QUERIES)}, got {match!r}")
+
         mesh_term = get_mesh_term_for_disease(disease_name)
         if not mesh_term:
             mesh_term = ""
         logging.info(f"Found MeSH term: {mesh_term}")
 
-        query = """
-        WITH all_trials AS (
-            -- Trials matching the original disease name (name 1)
-            SELECT
-                s.nct_id,
-                c.downcase_name AS condition_name,
-                s.phase,
-                s.overall_status,
-                s.source AS sponsor,
-                s.source_class,
-                s.official_title,
-                STRING_AGG(i.name, ', ') AS drug_names,
-                STRING_AGG(i.intervention_type, ', ') AS intervention_types
-            FROM
-                ctgov.conditions c
-            JOIN
-                ctgov.studies s ON c.nct_id = s.nct_id
-            JOIN
-                ctgov.interventions i ON s.nct_id = i.nct_id
-            WHERE
-                c.downcase_name = %s
-                AND s.study_type = 'INTERVENTIONAL'
-                AND i.intervention_type IN ('DRUG', 'BIOLOGICAL')
-            GROUP BY
-                s.nct_id, c.downcase_name, s.phase, s.overall_status, s.source, s.source_class, s.official_title
-
-            UNION
-
-            -- Trials matching the MeSH term (name 2)
-            SELECT
-                s.nct_id,
-                bc.downcase_mesh_term AS condition_name,
-                s.phase,
-                s.overall_status,
-                s.source AS sponsor,
-                s.source_class,
-                s.official_title,
-                STRING_AGG(i.name, ', ') AS drug_names,
-                STRING_AGG(i.intervention_type, ', ') AS intervention_types
-            FROM
-                ctgov.browse_conditions bc
-            JOIN
-                ctgov.studies s ON bc.nct_id = s.nct_id
-            JOIN
-                ctgov.interventions i ON s.nct_id = i.nct_id
-            WHERE
-                bc.downcase_mesh_term = %s
-                AND s.study_type = 'INTERVENTIONAL'
-                AND i.intervention_type IN ('DRUG', 'BIOLOGICAL')
-            GROUP BY
-                s.nct_id, bc.downcase_mesh_term, s.phase, s.overall_status, s.source, s.source_class, s.official_title
-        )
-        SELECT DISTINCT * FROM all_trials;
-        """
+        # Both names are matched against both condition tables in one pass each
+        names = [disease_name.lower()]
+        if mesh_term and mesh_term.lower() not in names:
+            names.append(mesh_term.lower())
+        if match == "prefix":
+            names = [_like_prefix(name) for name in names]
+        query = _TRIALS_QUERIES[match]
+        params = (names, names, after_nct_id, after_nct_id, limit, offset)
+
+        # Named (server-side) cursor streams rows from Postgres in pages of
+        # itersize instead of buffering the whole result set client-side;
+        # RealDictCursor hands back rows already keyed by column name
+        with self._acquire() as conn:
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                self._log_query_plan(conn, query, params)
+            # Unique name so concurrent generators never collide on a cursor
+            with conn.cursor(name=f"studies_{uuid.uuid4().hex}", cursor_factory=RealDictCursor) as cur:
+                cur.itersize = 1000
+                cur.execute(query, params)
+                for row in cur:
+                    row["drug_names"] = ", ".join(row["drug_names"] or [])
+                    row["intervention_types"] = ", ".join(row["intervention_types"] or [])
+                    yield row
 
-        with self.connection.cursor() as cur:
-            cur.execute(query, (disease_name.lower(), mesh_term.lower()))
-            columns = [desc[0] for desc in cur.description]
-            rows = cur.fetchall()
-            data = [dict(zip(columns, row)) for row in rows]
-        return data
\ No newline at end of file
+    def _log_query_plan(self, conn, query, params):
+        """
+        Logs Postgres' plan for the trials query, to check that the condition indexes are used.
+        """
+        with conn.cursor() as cur:
+            cur.execute("EXPLAIN " + query.strip().rstrip(";"), params)
+            plan = "\n".join(row[0] for row in cur.fetchall())
+        logging.debug(f"Trials query plan:\n{plan}")
\ No newline at end of file
@@ -3,8 +3,14 @@ from disease_db_client import DBClient
 from extractor import DrugExtractor
 import chembl_data_disease as chembl_data_disease
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import glob
 import logging
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(
     level=logging.INFO,
@@ -15,6 +21,104 @@ logging.basicConfig(
     ]
 )
 
+# Default number of drugs enriched from ChEMBL in parallel; keep below the ChEMBL
+# session's pool size
+CHEMBL_WORKERS = 8
+
+# Each batch is written as its own Parquet partition; --merge rebuilds the CSV from them
+OUT_DIR = "drugs_moa_target_parts"
+OUT_FILE = "drugs_moa_target_mod.csv"
+
+def _drug_list(row):
+    """
+    Returns the extracted drugs of an extractor row as a list of names.
+    """
+    drug_list = row["extracted_drugs"]
+    if isinstance(drug_list, str):
+        drug_list = [d.strip() for d in drug_list.split(",") if d.strip()]
+    return drug_list
+
+def _drug_key(drug):
+    """
+    Returns the key under which a drug name is looked up in ChEMBL; names that
+    differ only in case or surrounding spaces resolve to the same molecule.
+    """
+    return drug.strip().lower()
+
+def enrich_drug(chembl_ids, mol_types, approvals, moa_targets, target_types):
+    """
+    Assembles the ChEMBL annotations for one extracted drug: short MoA, targets, modality,
+    approval status for the disease and target types. Makes no requests itself:
+    mol_types, approvals and target_types are the pre-fetched id -> value lookups, and
+    moa_targets (the drug's mechanisms, with target ids) is its slice of the batched MoA lookup.
+    Returns a dict of per-drug lists/strings ready to be aggregated per trial.
+    """
+    target_list = [mt[2] for mt in moa_targets if mt[2] and mt[2] != "NA"]
+    moltype_list = [mol_types[cid] for cid in chembl_ids if cid]
+    if chembl_ids:
+        approval_status = approvals.get(chembl_ids[0], "NA")
+    else:
+        approval_status = "NA"
+    # Get MoA (short form)
+    moa_short = chembl_data_disease.get_moa_short(moa_targets)
+
+    # Target type for each mechanism (if target id is available);
+    # mt is a tuple: (chembl_id, moa, target, target_id)
+    target_ids = [mt[3] for mt in moa_targets if len(mt) == 4 and mt[3]]
+    target_type_list = []
+    for tgt_id in target_ids:
+        ttype = target_types.get(tgt_id)
+        if ttype and ttype != "NA":
+            target_type_list.append(ttype)
+    if not target_type_list:
+        target_type_list = ["NA"]
+
+    return {
+        "targets": target_list,
+        "moltypes": moltype_list,
+        "approval": approval_status,
+        "moa_short": moa_short if moa_short else "NA",
+        "target_types": target_type_list,
+    }
+
+def partition_path(args, disease_name):
+    """
+    Returns the Parquet partition file for the batch selected by args. The disease
+    (as a slug) and match mode are part of the name, so batches of different
+    diseases never collide; re-running the same batch overwrites its partition,
+    so reruns stay idempotent.
+    """
+    slug = re.sub(r"[^a-z0-9]+", "_", disease_name.lower()).strip("_")
+    if args.after_nct_id:
+        name = f"{slug}_{args.match}_batch_after_{args.after_nct_id}_{args.limit}.parquet"
+    else:
+        name = f"{slug}_{args.match}_batch_{args.offset}_{args.limit}.parquet"
+    return os.path.join(OUT_DIR, name)
+
+def merge_partitions(out_dir=OUT_DIR, out_file=OUT_FILE):
+    """
+    Rebuilds the output CSV from all batch partitions, seeded with the rows already
+    in out_file so an existing CSV is extended rather than replaced. A trial's rows
+    are taken from the most recently written partition that contains it (the
+    existing CSV counts as the oldest), so re-processed trials replace their older rows.
+    """
+    paths = sorted(glob.glob(os.path.join(out_dir, "*.parquet")), key=os.path.getmtime)
+    if not paths:
+        logging.warning(f"No partitions found in {out_dir}")
+        return
+    frames = [pd.read_parquet(path).assign(_partition=i) for i, path in enumerate(paths)]
+    if os.path.exists(out_file):
+        # Read as text so the "NA" placeholders stay strings instead of turning into NaN
+        existing = pd.read_csv(out_file, dtype=str, keep_default_na=False)
+        frames.insert(0, existing.assign(_partition=-1))
+        logging.info(f"Seeding merge with {len(existing)} existing rows from {out_file}")
+    df_all = pd.concat(frames, ignore_index=True)
+    latest = df_all.groupby("nct_id")["_partition"].transform("max")
+    df_final = df_all[df_all["_partition"] == latest].drop(columns="_partition")
+    # pyarrow's multithreaded CSV writer is much faster than DataFrame.to_csv on large outputs
+    pacsv.write_csv(pa.Table.from_pandas(df_final, preserve_index=False), out_file)
+    logging.info(f"Merged {len(paths)} partitions into {out_file} ({len(df_final)} rows).")
+
 def main():
     """
     Main pipeline for extracting drug information from clinical trial data.
@@ -22,14 +126,31 @@ def main():
     - Uses an LLM to extract drug names from each trial record.
     - For each extracted drug, fetches ChEMBL information: MoA (short form), target, modality, and approval status.
     - Aggregates results for each trial (NCT ID), handling multiple drugs and multiple targets/MoAs per drug.
-    - Writes/updates the results to a CSV file, ensuring each NCT ID is unique.
+    - Writes the batch's results to its own Parquet partition; --merge combines the
+      partitions into the CSV file, keeping each NCT ID's latest rows.
     """
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument("--offset", type=int, default=0, help="Start row")
-    parser.add_argument("--limit", type=int, default=1000, help="Batch size")
+    parser.add_argument("--offset", type=int, default=0, help="Start trial (trials are ordered by NCT ID)")
+    parser.add_argument("--limit", type=int, default=1000, help="Batch size, in trials")
+    parser.add_argument("--after-nct-id", default=None,
+                        help="Start after this NCT ID (keyset paging; use instead of a large --offset)")
+    parser.add_argument("--match", choices=["exact", "prefix"], default="exact",
+                        help="Match conditions exactly or by prefix of the disease/MeSH name")
+    parser.add_argument("--llm-workers", type=int, default=8,
+                        help="Concurrent requests sent to the LLM server during extraction")
+    parser.add_argument("--llm-batch-size", type=int, default=10,
+                        help="Intervention texts packed into one LLM prompt (1 disables batching)")
+    parser.add_argument("--chembl-workers", type=int, default=CHEMBL_WORKERS,
+                        help="Drugs looked up in ChEMBL concurrently")
+    parser.add_argument("--merge", action="store_true",
+                        help=f"Only rebuild {OUT_FILE} from the batch partitions in {OUT_DIR}/")
     args = parser.parse_args()
 
+    if args.merge:
+        merge_partitions()
+        return
+
     # Prompt user for disease name and fetch relevant data
     disease_name = input("Enter disease name: ").strip().lower()
     logging.info(f"User provided disease: {disease_name}")
@@ -39,15 +160,20 @@ def main():
     logging.info("Initializing database client...")
     db_client = DBClient()
     logging.info("Fetching data from the database...")
-    data = db_client.fetch_data(disease_name)
-    logging.info(f"Fetched {len(data)} rows from the database.")
-
-    # Select a batch of rows to process
-    batch_data = data[args.offset:args.offset + args.limit]
-    logging.info(f"Processing rows {args.offset} to {args.offset + len(batch_data)}.")
+    # Only the requested batch of trials is fetched; paging happens in SQL
+    batch_data = db_client.fetch_data(
+        disease_name, match=args.match, limit=args.limit, offset=args.offset, after_nct_id=args.after_nct_id
+    )
+    logging.info(f"Fetched {len(batch_data)} rows from the database.")
+    if args.after_nct_id:
+        logging.info(f"Processing trials after {args.after_nct_id}.")
+    else:
+        logging.info(f"Processing trials {args.offset} to {args.offset + len({r['nct_id'] for r in batch_data})}.")
+    if batch_data:
+        logging.info(f"Last NCT ID in this batch: {batch_data[-1]['nct_id']} (pass as --after-nct-id for the next batch)")
 
     logging.info("Initializing drug extractor...")
-    drug_extractor = DrugExtractor(llm_client)
+    drug_extractor = DrugExtractor(llm_client, max_workers=args.llm_workers, batch_size=args.llm_batch_size)
     logging.info("Extracting drug names using LLM...")
     extracted_drugs = drug_extractor.extract_drug_names(batch_data)
     logging.info(f"Extraction complete. Processed {len(extracted_drugs)} rows.")
@@ -57,20 +183,55 @@ def main():
         row["nct_id"]: ", ".join(row["extracted_drugs"]) if isinstance(row["extracted_drugs"], list) else row["extracted_drugs"]
         for row in extracted_drugs
     }
-    nctid_to_moa = {}
     nctid_to_target = {}
     nctid_to_moltype = {}
     nctid_to_approval = {}
     nctid_to_moa_short = {}
     nctid_to_target_type = {}  # New mapping for Target Type
 
-    # For each trial, process all extracted drugs and aggregate ChEMBL info
-    for row in extracted_drugs:
-        drug_list = row["extracted_drugs"]
-        if isinstance(drug_list, str):
-            drug_list = [d.strip() for d in drug_list.split(",") if d.strip()]
+    # The same drug shows up across many trials (often with different casing), so
+    # each distinct drug is resolved and enriched once and projected back per trial
+    row_drugs = [_drug_list(row) for row in extracted_drugs]
+    unique_drugs = {}
+    for drug_list in row_drugs:
+        for drug in drug_list:
+            unique_drugs.setdefault(_drug_key(drug), drug)
+    logging.info(f"{len(unique_drugs)} distinct drugs across {len(extracted_drugs)} trials")
+
+    # Resolve ChEMBL IDs up front, so molecule types can be fetched once per
+    # distinct ID and concurrently
+    with ThreadPoolExecutor(max_workers=args.chembl_workers) as ex:
+        key_to_chembl_ids = dict(zip(unique_drugs, ex.map(chembl_data_disease.get_chembl_id_exact, unique_drugs.values())))
+    mol_types = chembl_data_disease.fetch_molecule_types(
+        cid for ids in key_to_chembl_ids.values() for cid in ids
+    )
+    # Approval status is judged on each drug's first ChEMBL ID, in batched requests
+    approvals = chembl_data_disease.fetch_approval_statuses(
+        [ids[0] for ids in key_to_chembl_ids.values() if ids], disease_name
+    )
+    # MoA and target info for every resolved ID in one batched lookup, grouped per ID
+    moa_by_id = {}
+    for mt in chembl_data_disease.fetch_moa_targets_for_ids(
+        list(dict.fromkeys(cid for ids in key_to_chembl_ids.values() for cid in ids))
+    ):
+        moa_by_id.setdefault(mt[0], []).append(mt)
 
-        moa_blocks = []
+    # Target types for every mechanism's target in one batched lookup
+    target_types = chembl_data_disease.get_target_types(
+        list(dict.fromkeys(mt[3] for mts in moa_by_id.values() for mt in mts if len(mt) == 4 and mt[3]))
+    )
+
+    # Everything is fetched by now, so assembling each drug's annotations is a plain loop
+    drug_info = {
+        key: enrich_drug(
+            ids, mol_types, approvals,
+            [mt for cid in ids for mt in moa_by_id.get(cid, [])], target_types,
+        )
+        for key, ids in key_to_chembl_ids.items()
+    }
+
+    # For each trial, aggregate ChEMBL info over all its extracted drugs
+    for row, drug_list in zip(extracted_drugs, row_drugs):
         target_blocks = []
         moltype_blocks = []
         approval_blocks = []
@@ -78,41 +239,14 @@ def main():
         target_type_blocks = []  # New list for target types
 
         for drug in drug_list:
-            # Fetch ChEMBL IDs for the drug
-            chembl_ids = chembl_data_disease.get_chembl_id_exact(drug)
-            # Fetch MoA and target info for these IDs (now including target id)
-            moa_targets = chembl_data_disease.fetch_moa_targets_for_ids(chembl_ids)
-            # Get MoA (short form)
-            moa_str = chembl_data_disease.get_moa_short(moa_targets)
-            moa_blocks.append([s.strip() for s in moa_str.split(";")] if moa_str and moa_str != "NA" else [])
-            target_list = [mt[2] for mt in moa_targets if mt[2] and mt[2] != "NA"]
-            target_blocks.append(target_list)
-            moltype_list = [chembl_data_disease.fetch_molecule_type(cid) for cid in chembl_ids if cid]
-            moltype_blocks.append(moltype_list)
-            if chembl_ids:
-                approval_status = chembl_data_disease.fetch_approval_status(chembl_ids[0], disease_name)
-            else:
-                approval_status = "NA"
-            approval_blocks.append([approval_status])
-            moa_short = chembl_data_disease.get_moa_short(moa_targets)
-            moa_short_blocks.append(moa_short if moa_short else "NA")
-            
-            # New: Fetch target type for each mechanism (if target id is available)
-            target_type_list = []
-            for mt in moa_targets:
-                # mt is a tuple: (chembl_id, moa, target, target_id)
-                if len(mt) == 4:
-                    tgt_id = mt[3]
-                    if tgt_id:
-                        ttype = chembl_data_disease.get_target_type(tgt_id)
-                        if ttype and ttype != "NA":
-                            target_type_list.append(ttype)
-            if not target_type_list:
-                target_type_list = ["NA"]
-            target_type_blocks.append(target_type_list)
+            info = drug_info[_drug_key(drug)]
+            target_blocks.append(info["targets"])
+            moltype_blocks.append(info["moltypes"])
+            approval_blocks.append([info["approval"]])
+            moa_short_blocks.append(info["moa_short"])
+            target_type_blocks.append(info["target_types"])
 
         # Aggregate results for all drugs in the trial
-        nctid_to_moa[row["nct_id"]] = chembl_data_disease.format_multi_drug_output(moa_blocks)
         nctid_to_target[row["nct_id"]] = chembl_data_disease.format_multi_drug_output(target_blocks)
         nctid_to_moltype[row["nct_id"]] = chembl_data_disease.format_multi_drug_output(moltype_blocks)
         nctid_to_approval[row["nct_id"]] = chembl_data_disease.format_multi_drug_output(approval_blocks)
@@ -135,18 +269,14 @@ def main():
         # New column for Target Type
         row["Target Type"] = nctid_to_target_type.get(nct_id, "")
 
-    # Save or update the output CSV, ensuring unique NCT IDs
-    out_file = 'drugs_moa_target_mod.csv'
-    if os.path.exists(out_file):
-        df_existing = pd.read_csv(out_file)
-        # Remove rows with nct_id in current batch (to update them)
-        df_existing = df_existing[~df_existing["nct_id"].isin([row["nct_id"] for row in batch_data])]
-        df_new = pd.DataFrame(batch_data)
-        df_final = pd.concat([df_existing, df_new], ignore_index=True)
+    # Write this batch as its own partition instead of rewriting the whole CSV
+    if batch_data:
+        os.makedirs(OUT_DIR, exist_ok=True)
+        out_path = partition_path(args, disease_name)
+        pq.write_table(pa.Table.from_pylist(batch_data), out_path)
+        logging.info(f"Saved {len(batch_data)} rows to {out_path}. Run with --merge to rebuild {OUT_FILE}.")
     else:
-        df_final = pd.DataFrame(batch_data)
-    df_final.to_csv(out_file, index=False)
-    logging.info(f"Saved/updated {len(batch_data)} rows to {out_file}.")
+        logging.info("No rows in this batch; nothing saved.")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
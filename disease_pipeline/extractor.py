@@ -1,11 +1,14 @@
+import hashlib
+import json
 import logging
+import re
+import sqlite3
+import threading
+import requests
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 
-class DrugExtractor:
-    def __init__(self, llm_client):
-        self.llm_client = llm_client
-
-    def extract_drug_names(self, intervention_data):
-        prompt_template = (
+PROMPT_TEMPLATE = (
         '''
         You are a clinical-trials expert whose sole task is to extract CORE DRUG NAMES from a free-text list of interventions.
 
@@ -69,18 +72,264 @@ class DrugExtractor:
         DrugX, DrugY
 
         '''
-        )
-
-        all_results = []
-        for idx, row in enumerate(intervention_data, 1):
-            logging.info(f"Processing row {idx}/{len(intervention_data)}: nct_id {row['nct_id']}")
-            prompt = prompt_template + f"\ninput:\n{row['drug_names']}\n\noutput:"
-            response = self.llm_client.extract_drugs(prompt)
-            drugs = [d.strip() for d in response.split(',') if d.strip()]
-            all_results.append({
-                "nct_id": row["nct_id"],
-                "original_drug_names": row["drug_names"],
-                "extracted_drugs": drugs
-            })
+)
+
+# PROMPT_TEMPLATE (BATCH_SYSTEM_PROMPT for calls that pack several numbered
+# intervention texts into one prompt) is sent as the system prompt and only the
+# input goes in the prompt, so the LLM server sees the same leading context on
+# every call and can reuse it
+BATCH_SYSTEM_PROMPT = PROMPT_TEMPLATE + (
+    "\nApply the rules above to each numbered input independently.\n"
+    "Return **only** a JSON array of strings with exactly one element per input, in input order.\n"
+    "Each element is the output for that input (an empty string if no core drug name remains).\n"
+)
+
+# Intervention texts that never contain a drug (compared lowercased, per comma-separated item)
+_NON_DRUG_ITEMS = {
+    "", "placebo", "placebos", "vehicle", "control", "saline", "normal saline", "sham",
+    "no intervention", "placebo comparator", "standard of care", "usual care",
+}
+
+# Single words the prompt's rules would drop: routes/forms, stereo descriptors and
+# salt words (rule 2) and generic drug classes. This is a heuristic, not a full
+# vocabulary; anything it misses that looks like a plural (see _looks_plural)
+# still goes to the LLM.
+_NON_DRUG_WORDS = {
+    "inhaled", "injected", "oral", "topical", "intravenous", "subcutaneous", "intramuscular", "nasal",
+    "mdi", "powder", "patch", "spray", "infusion", "injection", "cream", "ointment", "gel", "tablet",
+    "capsule", "solution", "suspension", "inhaler", "nebulized", "drops", "formulation",
+    "racemic", "levo", "dex",
+    "tartrate", "hydrochloride", "acetate", "fumarate", "succinate", "phosphate", "sodium", "potassium",
+    "corticosteroid", "corticosteroids", "nsaid", "nsaids", "antibiotic", "antibiotics",
+    "steroid", "steroids", "chemotherapy", "immunotherapy", "vaccine", "vitamins", "supplement",
+    "statin", "opioid", "bisphosphonate", "antihistamine", "antidepressant", "antipsychotic",
+    "benzodiazepine", "anticoagulant", "antiplatelet", "antiviral", "antifungal", "antiemetic",
+    "anticonvulsant", "antiepileptic", "antihypertensive", "diuretic", "bronchodilator",
+    "immunosuppressant", "biologic", "hormone", "probiotic", "analgesic", "sedative",
+    "anesthetic", "anaesthetic", "beta-blocker", "triptan", "retinoid", "glucocorticoid", "vitamin",
+}
+
+def _looks_plural(word):
+    """
+    Returns True for a single word that reads like a plural class name ("Statins",
+    "Opioids"). Drug names ending in -us/-is/-ss (e.g. "Tacrolimus") don't count.
+    """
+    word = word.lower()
+    return word.endswith("s") and not word.endswith(("ss", "us", "is"))
+
+# One drug-like token: letters/digits with optional internal hyphens (e.g. "tofacitinib", "CGB-500")
+_SINGLE_DRUG_RE = re.compile(r"[A-Za-z][A-Za-z0-9]*(?:-[A-Za-z0-9]+)*")
+# Stereo prefixes ("D-", "L-", "DL-") must go through the LLM, which strips them
+_STEREO_PREFIX_RE = re.compile(r"(?:d|l|dl|r|s)-", re.IGNORECASE)
+
+def _trivial_extraction(drug_names):
+    """
+    Returns the extraction for inputs whose answer is obvious without the LLM:
+    [] for placebo/control-only text, [name] for a single bare drug-like word that
+    isn't a known class word or plural. Returns None when the LLM is needed.
+    """
+    text = (drug_names or "").strip()
+    items = [item.strip().lower() for item in text.split(",")]
+    if all(item in _NON_DRUG_ITEMS for item in items):
+        return []
+    if (_SINGLE_DRUG_RE.fullmatch(text) and text.lower() not in _NON_DRUG_WORDS
+            and not _looks_plural(text) and not _STEREO_PREFIX_RE.match(text)):
+        return [text]
+    return None
+
+def _split_drugs(output):
+    """
+    Splits one comma-separated LLM output into drug names.
+    """
+    return [d.strip() for d in output.split(',') if d.strip()]
+
+def _parse_batch_response(response, n):
+    """
+    Parses the JSON array answer to a batch prompt into n drug lists.
+    Returns None if the answer isn't an array of n strings (or string lists).
+    """
+    start, end = response.find("["), response.rfind("]")
+    if start == -1 or end < start:
+        return None
+    try:
+        outputs = json.loads(response[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(outputs, list) or len(outputs) != n:
+        return None
+    results = []
+    for output in outputs:
+        if isinstance(output, list) and all(isinstance(d, str) for d in output):
+            output = ", ".join(output)
+        if not isinstance(output, str):
+            return None
+        results.append(_split_drugs(output))
+    return results
+
+def _done_future(result):
+    """
+    Returns an already-completed Future holding result.
+    """
+    future = Future()
+    future.set_result(result)
+    return future
+
+def _extraction_row(row, text, future):
+    """
+    Builds the extractor output dict for row once the extraction future for its
+    stripped text is done (the future's result maps texts to drug lists).
+    """
+    return {
+        "nct_id": row["nct_id"],
+        "original_drug_names": row["drug_names"],
+        # Copy so rows sharing a text never share a mutable list
+        "extracted_drugs": list(future.result()[text])
+    }
+
+class ExtractionCache:
+    """
+    On-disk cache of LLM drug extractions, so identical intervention texts are only
+    sent to the LLM once across rows and runs.
+    """
+    def __init__(self, path=".drug_cache.sqlite"):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS extractions (key TEXT PRIMARY KEY, drugs TEXT NOT NULL)")
+            self._conn.commit()
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT drugs FROM extractions WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, drugs):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO extractions (key, drugs) VALUES (?, ?)", (key, json.dumps(drugs)))
+            self._conn.commit()
+
+class DrugExtractor:
+    def __init__(self, llm_client, max_workers=8, cache_path=".drug_cache.sqlite", batch_size=10):
+        self.llm_client = llm_client
+        # Number of LLM requests in flight at once
+        self.max_workers = max_workers
+        # cache_path=None disables the extraction cache
+        self.cache = ExtractionCache(cache_path) if cache_path else None
+        # Intervention texts packed into one prompt; 1 sends every text on its own
+        self.batch_size = max(1, batch_size)
+
+    def _cache_key(self, drug_names):
+        # Model and prompt are part of the key so changing either invalidates old entries
+        return ExtractionCache.make_key(self.llm_client.model, PROMPT_TEMPLATE, drug_names)
+
+    def _lookup(self, drug_names):
+        """
+        Returns the drugs for intervention texts that don't need the LLM: trivial
+        inputs and texts already in the cache. Returns None otherwise.
+        """
+        drugs = _trivial_extraction(drug_names)
+        if drugs is None and self.cache:
+            drugs = self.cache.get(self._cache_key(drug_names))
+        return drugs
+
+    def _extract_one(self, drug_names):
+        """
+        Returns the core drug names in one intervention text, asking the LLM with a
+        single-input prompt and caching the answer.
+        """
+        prompt = "".join(["input:\n", drug_names, "\n\noutput:"])
+        try:
+            response = self.llm_client.extract_drugs(prompt, system=PROMPT_TEMPLATE)
+        except requests.RequestException as e:
+            # One failed text shouldn't sink the whole batch; it isn't cached,
+            # so the next run retries it
+            logging.warning(f"LLM extraction failed for {drug_names!r}: {e}")
+            return []
+        drugs = _split_drugs(response)
+        if self.cache:
+            self.cache.set(self._cache_key(drug_names), drugs)
+        return drugs
+
+    def _extract_group(self, texts):
+        """
+        Extracts the drugs of several intervention texts with one numbered prompt
+        that asks for a JSON array. Falls back to one prompt per text if the
+        request fails or the answer doesn't parse.
+        Returns a dict of text -> drug list.
+        """
+        if len(texts) > 1:
+            prompt = "".join([
+                "inputs:\n",
+                "\n".join(f"{i}. {text}" for i, text in enumerate(texts, 1)),
+                "\n\noutput:",
+            ])
+            try:
+                response = self.llm_client.extract_drugs(prompt, system=BATCH_SYSTEM_PROMPT)
+                results = _parse_batch_response(response, len(texts))
+            except requests.RequestException as e:
+                logging.warning(f"Batched LLM extraction failed for {len(texts)} texts: {e}")
+                results = None
+            if results is not None:
+                if self.cache:
+                    for text, drugs in zip(texts, results):
+                        self.cache.set(self._cache_key(text), drugs)
+                return dict(zip(texts, results))
+            logging.warning(f"Falling back to single-text prompts for {len(texts)} texts")
+        return {text: self._extract_one(text) for text in texts}
+
+    def extract_drug_names(self, intervention_data):
+        """
+        Returns the extraction dicts for every row of intervention_data, in order.
+        See iter_extract_drug_names to consume them as they become ready.
+        """
+        all_results = list(self.iter_extract_drug_names(intervention_data))
         logging.info(f"All rows processed. Total extracted: {len(all_results)}")
-        return all_results
\ No newline at end of file
+        return all_results
+
+    def iter_extract_drug_names(self, intervention_data):
+        """
+        Yields {"nct_id", "original_drug_names", "extracted_drugs"} for each row of
+        intervention_data (any iterable of row dicts), in input order, as soon as that
+        row's extraction is done.
+        Many trials list the exact same interventions, so each distinct text is
+        extracted once and its result is handed to every row that uses it. Texts
+        that need the LLM are sent batch_size at a time in one prompt.
+        """
+        # Each call is an I/O-bound POST, so run up to max_workers of them at once
+        with ThreadPoolExecutor(max_workers=self.max_workers) as ex:
+            futures = {}
+            group = []
+            pending = deque()
+
+            def submit_group():
+                logging.info(f"Sending {len(group)} intervention texts to the LLM "
+                             f"({len(futures) + len(group)} distinct so far)")
+                future = ex.submit(self._extract_group, list(group))
+                for text in group:
+                    futures[text] = future
+                group.clear()
+
+            for row in intervention_data:
+                text = (row["drug_names"] or "").strip()
+                if text not in futures and text not in group:
+                    drugs = self._lookup(text)
+                    if drugs is not None:
+                        futures[text] = _done_future({text: drugs})
+                    else:
+                        group.append(text)
+                        if len(group) >= self.batch_size:
+                            submit_group()
+                pending.append((row, text))
+                # Hand out finished rows from the front while later ones are still queued
+                while pending and pending[0][1] in futures and futures[pending[0][1]].done():
+                    row_done, text_done = pending.popleft()
+                    yield _extraction_row(row_done, text_done, futures[text_done])
+            if group:
+                submit_group()
+            while pending:
+                row_done, text_done = pending.popleft()
+                yield _extraction_row(row_done, text_done, futures[text_done])
\ No newline at end of file
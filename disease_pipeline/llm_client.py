@@ -1,5 +1,7 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,16 +15,35 @@ class LLMClient:
 
         self.session = requests.Session()
         self.session.auth = (self.username, self.password)
+        # Room for concurrent extraction requests to share keep-alive connections;
+        # an overloaded server (429/5xx) is retried with backoff. Generation has no
+        # side effects, so retrying the POST is safe.
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=1,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=("POST",),
+                respect_retry_after_header=True,
+            ),
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
-    def extract_drugs(self, prompt):
+    def extract_drugs(self, prompt, system=""):
+        # A fixed system prompt is the same leading context on every call, so the
+        # server can reuse its cached prefix and only process the per-call prompt
         url = f"{self.base_url}/api/generate"
         payload = {
             "model": self.model,
             "prompt": prompt,
-            "system": "",
+            "system": system,
             "stream": False,
             "options": {}
         }
-        response = self.session.post(url, json=payload)
+        # (connect, read) seconds; generation on a busy server can take a while
+        response = self.session.post(url, json=payload, timeout=(10, 300))
         response.raise_for_status()
         return response.json().get("response", "")
\ No newline at end of file
@@ -1,4 +1,10 @@
+import io
+import threading
 import requests
+import requests_cache
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import xml.etree.ElementTree as ET
 import time
 from fastapi import HTTPException
@@ -11,9 +17,52 @@ RATE_LIMIT_RETRY_PERIOD = 300
 EMAIL = os.getenv('NCBI_EMAIL')
 BASE_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
 
+# Shared session so repeated eutils lookups reuse the same keep-alive connection.
+# MeSH mappings practically never change, so responses are kept on disk
+# (mesh_cache.sqlite) for a week.
+_SESSION = requests_cache.CachedSession(
+    "mesh_cache",
+    backend="sqlite",
+    expire_after=7 * 24 * 3600,
+    allowable_methods=("GET",),
+)
+# Retry transient eutils failures with backoff; a 429 that outlasts the retries is
+# still returned and handled below
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=4,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    ),
+))
+
+# NCBI allows 10 requests/s with an API key and 3/s without; space requests
+# accordingly instead of sleeping after every call
+_MIN_INTERVAL = 0.1 if NCBI_API_KEY else 0.34
+_throttle_lock = threading.Lock()
+_next_request_at = 0.0
+
+def _throttle():
+    """
+    Blocks until the next eutils request slot, so callers stay under NCBI's rate limit.
+    """
+    global _next_request_at
+    with _throttle_lock:
+        now = time.monotonic()
+        wait = _next_request_at - now
+        _next_request_at = max(now, _next_request_at) + _MIN_INTERVAL
+    if wait > 0:
+        time.sleep(wait)
+
 def get_mesh_term_for_disease(disease_name):
     """
     Fetch the MeSH term for a given disease name from the NCBI MeSH database.
+    Lookups are cached per normalized name, in-process and on disk.
     
     Args:
         disease_name (str): The disease name to search for.
@@ -21,6 +70,10 @@ def get_mesh_term_for_disease(disease_name):
     Returns:
         str: The MeSH term for the disease, or None if not found.
     """
+    return _lookup_mesh_term(disease_name.strip().lower())
+
+@lru_cache(maxsize=2048)
+def _lookup_mesh_term(disease_name):
     params = {
         "db": "mesh",           
         "term": disease_name,   
@@ -30,8 +83,12 @@ def get_mesh_term_for_disease(disease_name):
 
     try:
         # Send the request to the API
-        response = requests.get(BASE_URL + "esearch.fcgi", params=params)
-        time.sleep(1)
+        # Serve from the disk cache without spending a rate-limit slot when possible;
+        # requests-cache answers 504 when the response isn't cached
+        response = _SESSION.get(BASE_URL + "esearch.fcgi", params=params, only_if_cached=True)
+        if response.status_code == 504:
+            _throttle()
+            response = _SESSION.get(BASE_URL + "esearch.fcgi", params=params, timeout=(5, 30))
         if response.status_code == 429:
             # raise Exception("Too Many Requests: You are being rate-limited. Please try again later.")
             rate_limited_until = time.time() + RATE_LIMIT_RETRY_PERIOD
@@ -39,16 +96,17 @@ def get_mesh_term_for_disease(disease_name):
 
         response.raise_for_status()
 
-        # Parse the XML response
-        root = ET.fromstring(response.content)
-        
-        # Find the <TermSet> with <Field> == 'MeSH Terms'
-        for term_set in root.findall(".//TermSet"):
-            field = term_set.find("Field")
-            term = term_set.find("Term")
+        # Parse the XML response incrementally, stopping at the first
+        # <TermSet> with <Field> == 'MeSH Terms'
+        for _, elem in ET.iterparse(io.BytesIO(response.content), events=("end",)):
+            if elem.tag != "TermSet":
+                continue
+            field = elem.find("Field")
+            term = elem.find("Term")
             if field is not None and term is not None and field.text == "MeSH Terms":
                 # Clean the MeSH term (remove quotes and brackets)
                 return term.text.replace('"', '').replace("[MeSH Terms]", "").strip()
+            elem.clear()
 
         return None
     
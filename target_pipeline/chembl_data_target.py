@@ -1,5 +1,64 @@
-import requests
+import re
+import orjson
+import requests_cache
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException
+from urllib3.util.retry import Retry
 
+# Shared session so every ChEMBL call reuses pooled keep-alive connections.
+# Responses are also cached on disk (chembl_cache.sqlite) for a day, since
+# ChEMBL records don't change between runs of the pipeline.
+_SESSION = requests_cache.CachedSession(
+    "chembl_cache",
+    backend="sqlite",
+    expire_after=24 * 3600,
+    allowable_methods=("GET",),
+)
+# Transient errors and rate limiting are retried with backoff (honouring Retry-After);
+# once retries run out the last response is returned, so callers' status checks still apply.
+# Sized for the drug workers in target_main each running a batched lookup.
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=20,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET",),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    ),
+))
+
+def _json(resp):
+    """
+    Decodes a response body with orjson, which is much faster than resp.json() on the large ChEMBL payloads.
+    """
+    return orjson.loads(resp.content)
+
+# (connect, read) seconds, so a stalled ChEMBL connection can't hang the pipeline
+_TIMEOUT = (5, 30)
+# drug_indication pages (up to 1000 rows) can take ChEMBL longer to produce
+_INDICATION_TIMEOUT = (5, 60)
+
+# Concurrent ChEMBL requests per batched lookup
+_MAX_WORKERS = 8
+
+def _get(url, params=None, timeout=_TIMEOUT):
+    """
+    GET through the shared session. Returns None if the request itself fails
+    (e.g. a timeout or connection error that outlasted the retries), so callers
+    treat it like any other failed lookup.
+    """
+    try:
+        return _SESSION.get(url, params=params, timeout=timeout)
+    except RequestException as e:
+        print(f"[WARN] Request failed for {url}: {e}")
+        return None
+
+@lru_cache(maxsize=4096)
 def get_target_chembl_id(target_input):
     """
     Given a gene symbol or ChEMBL target ID, returns the ChEMBL target ID.
@@ -7,9 +66,9 @@ def get_target_chembl_id(target_input):
     if target_input.upper().startswith("CHEMBL"):
         return target_input
     url = f"https://www.ebi.ac.uk/chembl/api/data/target.json?target_components__target_component_synonyms__component_synonym__iexact={target_input}&limit=1"
-    resp = requests.get(url)
-    if resp.status_code == 200:
-        targets = resp.json().get("targets", [])
+    resp = _get(url)
+    if resp is not None and resp.status_code == 200:
+        targets = _json(resp).get("targets", [])
         if targets:
             return targets[0]["target_chembl_id"]
     return None
@@ -17,78 +76,165 @@ def get_target_chembl_id(target_input):
 def get_drugs_for_target(target_chembl_id):
     """
     Returns a list of drugs (dicts) that act on the given target (from ChEMBL).
+    Preferred names are fetched for all drugs in batched molecule requests.
     """
     url = f"https://www.ebi.ac.uk/chembl/api/data/mechanism.json?target_chembl_id={target_chembl_id}&limit=1000"
-    resp = requests.get(url)
-    drugs = []
-    if resp.status_code == 200:
-        seen = set()
-        for mech in resp.json().get("mechanisms", []):
-            mol = mech.get("molecule_chembl_id")
-            if mol and mol not in seen:
-                seen.add(mol)
-                # Optionally fetch pref_name
-                mol_url = f"https://www.ebi.ac.uk/chembl/api/data/molecule/{mol}.json"
-                mol_resp = requests.get(mol_url)
-                pref_name = mol_resp.json().get("pref_name") if mol_resp.status_code == 200 else None
-                drugs.append({"molecule_chembl_id": mol, "pref_name": pref_name})
-    return drugs
-
-def fetch_molecule_type(chembl_id):
-    """
-    Given a ChEMBL ID, fetches the molecule type (e.g., 'Small molecule', 'Protein').
-    Returns 'NA' if not found or on error.
+    resp = _get(url)
+    if resp is None or resp.status_code != 200:
+        return []
+    mol_ids = list(dict.fromkeys(
+        mech.get("molecule_chembl_id") for mech in _json(resp).get("mechanisms", []) if mech.get("molecule_chembl_id")
+    ))
+    molecules = _fetch_in_chunks(
+        "https://www.ebi.ac.uk/chembl/api/data/molecule.json", "molecule_chembl_id", mol_ids,
+        "molecules", {"only": "molecule_chembl_id,pref_name"},
+    )
+    pref_names = {mol.get("molecule_chembl_id"): mol.get("pref_name") for mol in molecules}
+    return [{"molecule_chembl_id": mol, "pref_name": pref_names.get(mol)} for mol in mol_ids]
+
+def _chunks(items, size):
     """
-    url = f"https://www.ebi.ac.uk/chembl/api/data/molecule/{chembl_id}.json"
-    resp = requests.get(url)
-    if resp.status_code == 200:
-        return resp.json().get("molecule_type", "NA")
-    return "NA"
+    Yields consecutive slices of items with at most size elements.
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _get_all_pages(url, params, key):
+    """
+    GETs a ChEMBL list endpoint and follows page_meta.next until exhausted.
+    Returns the concatenated `key` rows, or None if any page failed.
+    """
+    rows = []
+    while url:
+        resp = _get(url, params=params)
+        if resp is None:
+            return None
+        if resp.status_code != 200:
+            print(f"[WARN] {key} fetch failed ({resp.status_code}) for {url}")
+            return None
+        payload = _json(resp)
+        rows.extend(payload.get(key, []))
+        next_page = (payload.get("page_meta") or {}).get("next")
+        # `next` is a path that already carries the filters
+        url = f"https://www.ebi.ac.uk{next_page}" if next_page else None
+        params = None
+    return rows
+
+def _fetch_in_chunks(url, id_field, ids, key, extra_params=None):
+    """
+    Fetches the `key` rows of a ChEMBL list endpoint for many IDs with
+    `{id_field}__in` filters (100 IDs per request, run concurrently).
+    Chunks that fail are skipped.
+    """
+    def fetch_chunk(chunk):
+        params = {f"{id_field}__in": ",".join(chunk), "limit": 1000, "offset": 0}
+        params.update(extra_params or {})
+        return _get_all_pages(url, params, key) or []
+
+    rows = []
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as ex:
+        for chunk_rows in ex.map(fetch_chunk, _chunks(ids, 100)):
+            rows.extend(chunk_rows)
+    return rows
+
+def fetch_molecule_types(chembl_ids):
+    """
+    For a list of ChEMBL IDs, fetches the molecule types (e.g., 'Small molecule', 'Protein')
+    in batched requests. Returns a dict of chembl_id -> molecule type
+    ('NA' for IDs that were not found or whose request failed).
+    """
+    unique_ids = list(dict.fromkeys(cid for cid in chembl_ids if cid))
+    types = {cid: "NA" for cid in unique_ids}
+    molecules = _fetch_in_chunks(
+        "https://www.ebi.ac.uk/chembl/api/data/molecule.json", "molecule_chembl_id", unique_ids,
+        "molecules", {"only": "molecule_chembl_id,molecule_type"},
+    )
+    for mol in molecules:
+        if mol.get("molecule_chembl_id") in types:
+            types[mol["molecule_chembl_id"]] = mol.get("molecule_type", "NA")
+    return types
 
 def fetch_moa_targets_for_ids(chembl_ids, filter_target=None):
     """
     For a list of ChEMBL IDs, fetches mechanism of action (MoA) and target information.
     If filter_target is set, only returns mechanisms for that target.
+    Mechanisms of all IDs are fetched in batched requests, then the symbols of
+    all distinct targets likewise.
     Returns a list of tuples: (chembl_id, mechanism_of_action, target_symbol).
     """
-    mechanisms = []
+    chembl_ids = list(chembl_ids)
+    unique_ids = list(dict.fromkeys(cid for cid in chembl_ids if cid))
+    extra_params = {"only": "molecule_chembl_id,mechanism_of_action,target_chembl_id"}
+    if filter_target:
+        # Let ChEMBL drop the other targets' mechanisms
+        extra_params["target_chembl_id"] = filter_target
+    mechanisms = _fetch_in_chunks(
+        "https://www.ebi.ac.uk/chembl/api/data/mechanism.json", "molecule_chembl_id", unique_ids,
+        "mechanisms", extra_params,
+    )
+    by_molecule = {}
+    for mech in mechanisms:
+        by_molecule.setdefault(mech.get("molecule_chembl_id"), []).append(mech)
+
+    pairs = []
     for chembl_id in chembl_ids:
-        url = f"https://www.ebi.ac.uk/chembl/api/data/mechanism.json?molecule_chembl_id={chembl_id}&limit=1000"
-        resp = requests.get(url)
-        if resp.status_code == 200:
-            for mech in resp.json().get("mechanisms", []):
-                tgt_id = mech.get("target_chembl_id")
-                if filter_target and tgt_id != filter_target:
-                    continue
-                moa = mech.get("mechanism_of_action") or "NA"
-                tgt_symbol = fetch_target_symbol(tgt_id) if tgt_id else "NA"
-                mechanisms.append((chembl_id, moa, tgt_symbol))
-    return mechanisms
-
-def fetch_target_symbol(target_chembl_id):
-    """
-    Given a ChEMBL target ID, fetches the gene symbol (GENE_SYMBOL) for the target.
-    Falls back to the preferred name if no gene symbol is found.
-    """
-    url = f"https://www.ebi.ac.uk/chembl/api/data/target/{target_chembl_id}.json"
-    resp = requests.get(url)
-    if resp.status_code == 200:
-        target = resp.json()
-        for comp in target.get("target_components", []):
-            for syn in comp.get("target_component_synonyms", []):
-                if syn.get("syn_type") == "GENE_SYMBOL":
-                    return syn.get("component_synonym", "NA")
-        return target.get("pref_name", "NA")
-    return "NA"
+        for mech in by_molecule.get(chembl_id, []):
+            tgt_id = mech.get("target_chembl_id")
+            if filter_target and tgt_id != filter_target:
+                continue
+            moa = mech.get("mechanism_of_action") or "NA"
+            pairs.append((chembl_id, moa, tgt_id))
+    symbols = fetch_target_symbols(tgt_id for _, _, tgt_id in pairs)
+    return [(chembl_id, moa, symbols[tgt_id] if tgt_id else "NA") for chembl_id, moa, tgt_id in pairs]
 
+# Run-level target ChEMBL ID -> symbol table, so targets already resolved in this
+# run are dict hits instead of requests.
+_TARGET_SYMBOLS = {}
+
+def _target_symbol(target):
+    """
+    Returns the gene symbol of a ChEMBL target record, or its preferred name.
+    """
+    for comp in target.get("target_components", []):
+        for syn in comp.get("target_component_synonyms", []):
+            if syn.get("syn_type") == "GENE_SYMBOL":
+                return syn.get("component_synonym", "NA")
+    return target.get("pref_name", "NA")
+
+def fetch_target_symbols(target_chembl_ids):
+    """
+    For a list of ChEMBL target IDs, fetches the gene symbol (GENE_SYMBOL) of each
+    target in batched requests. Returns a dict of target ChEMBL ID -> gene symbol
+    (or preferred name; 'NA' for targets that were not found or whose request failed).
+    Only targets not already in the run's symbol table are requested.
+    """
+    unique_ids = list(dict.fromkeys(tid for tid in target_chembl_ids if tid))
+    missing = [tid for tid in unique_ids if tid not in _TARGET_SYMBOLS]
+    if missing:
+        targets = _fetch_in_chunks(
+            "https://www.ebi.ac.uk/chembl/api/data/target.json", "target_chembl_id", missing,
+            "targets", {"only": "target_chembl_id,pref_name,target_components"},
+        )
+        for target in targets:
+            if target.get("target_chembl_id"):
+                _TARGET_SYMBOLS[target["target_chembl_id"]] = _target_symbol(target)
+    return {tid: _TARGET_SYMBOLS.get(tid, "NA") for tid in unique_ids}
+
+# Word-start anchor keeps "antagonist" from being reported as "agonist"
+_MOA_RE = re.compile(r"\b(inhibitor|agonist|antagonist|modulator|blocker|activator)", re.IGNORECASE)
+
+# The same MoA strings (e.g. "Cyclooxygenase inhibitor") recur across many drugs
+@lru_cache(maxsize=4096)
 def extract_moa_keyword(moa):
     """
     Extracts a keyword from the MoA string (e.g., 'inhibitor', 'agonist').
     """
-    for kw in ["inhibitor", "agonist", "antagonist", "modulator", "blocker", "activator"]:
-        if kw in moa.lower():
-            return kw
-    return moa.split()[-1] if moa else "NA"
+    if not moa:
+        return "NA"
+    m = _MOA_RE.search(moa)
+    if m:
+        return m.group(1).lower()
+    return moa.split()[-1]
 
 def get_moa_short(moa_targets):
     """
@@ -109,10 +255,10 @@ def get_indications_for_drug(chembl_id):
     Each dict contains at least 'indication_name' and 'max_phase_for_ind'.
     """
     url = f"https://www.ebi.ac.uk/chembl/api/data/drug_indication.json?molecule_chembl_id={chembl_id}&limit=1000"
-    resp = requests.get(url)
+    resp = _get(url, timeout=_INDICATION_TIMEOUT)
     indications = []
-    if resp.status_code == 200:
-        for ind in resp.json().get("drug_indications", []):
+    if resp is not None and resp.status_code == 200:
+        for ind in _json(resp).get("drug_indications", []):
             # Use efo_term or mesh_heading as indication name
             name = (ind.get("efo_term") or ind.get("mesh_heading") or "NA")
             indications.append({
@@ -137,11 +283,16 @@ def get_drug_synonyms(chembl_id):
     """
     Returns a list of all synonyms (including pref_name) for a given ChEMBL drug ID.
     """
+    return list(_get_drug_synonyms_cached(chembl_id))
+
+# Looked up again for every indication of a drug that has no trials under its preferred name
+@lru_cache(maxsize=4096)
+def _get_drug_synonyms_cached(chembl_id):
     url = f"https://www.ebi.ac.uk/chembl/api/data/molecule/{chembl_id}.json"
-    resp = requests.get(url)
+    resp = _get(url)
     names = set()
-    if resp.status_code == 200:
-        data = resp.json()
+    if resp is not None and resp.status_code == 200:
+        data = _json(resp)
         if data.get("pref_name"):
             names.add(data["pref_name"])
         for syn in data.get("molecule_synonyms", []):
@@ -149,4 +300,4 @@ def get_drug_synonyms(chembl_id):
                 names.add(syn["synonym"])
             if syn.get("molecule_synonym"):
                 names.add(syn["molecule_synonym"])
-    return list(names)
\ No newline at end of file
+    return tuple(names)
\ No newline at end of file
@@ -1,33 +1,58 @@
 import os
-import psycopg2
+import threading
+import uuid
+from contextlib import contextmanager
+from psycopg2.pool import ThreadedConnectionPool
+from psycopg2.extras import RealDictCursor
 from dotenv import load_dotenv
 
 load_dotenv()
 
 class TargetDBClient:
+    # Shared by every TargetDBClient so the drug workers each get their own warm connection
+    _pool = None
+    _pool_lock = threading.Lock()
+
     def __init__(self):
         self.host = os.getenv("db_host")
         self.port = os.getenv("db_port")
         self.userid = os.getenv("db_userid")
         self.pwd = os.getenv("db_password")
-        self.connection = self.connect_to_db()
+        self._pool = self.connect_to_db()
 
     def connect_to_db(self):
-        return psycopg2.connect(
-            host=self.host,
-            port=self.port,
-            user=self.userid,
-            password=self.pwd,
-            dbname="aact_db"
-        )
+        with TargetDBClient._pool_lock:
+            if TargetDBClient._pool is None:
+                TargetDBClient._pool = ThreadedConnectionPool(
+                    2, 16,
+                    host=self.host,
+                    port=self.port,
+                    user=self.userid,
+                    password=self.pwd,
+                    dbname="aact_db"
+                )
+        return TargetDBClient._pool
+
+    @contextmanager
+    def _acquire(self):
+        """
+        Borrows a connection from the pool and returns it when done.
+        """
+        conn = self._pool.getconn()
+        try:
+            yield conn
+        finally:
+            self._pool.putconn(conn)
 
     def fetch_trials_for_drug_and_indication(self, drug_name, indication_name):
         """
         Fetches all clinical trial rows for a given drug and indication.
-        Returns a list of dicts with all relevant columns.
+        Returns a list of dicts with all relevant columns, one per trial (a trial
+        matching several conditions is reported once, ordered by nct_id).
+        See README for the trigram indexes that keep the LIKE filters fast.
         """
         query = f"""
-        SELECT
+        SELECT DISTINCT ON (s.nct_id)
             s.nct_id,
             c.downcase_name AS condition_name,
             s.phase,
@@ -49,11 +74,17 @@ class TargetDBClient:
             AND i.intervention_type IN ('DRUG', 'BIOLOGICAL')
             AND LOWER(i.name) LIKE %s
         GROUP BY
-            s.nct_id, c.downcase_name, s.phase, s.overall_status, s.source, s.source_class, s.official_title;
+            s.nct_id, c.downcase_name, s.phase, s.overall_status, s.source, s.source_class, s.official_title
+        ORDER BY
+            s.nct_id, c.downcase_name;
         """
-        with self.connection.cursor() as cur:
-            cur.execute(query, (f"%{indication_name.lower()}%", f"%{drug_name.lower()}%"))
-            columns = [desc[0] for desc in cur.description]
-            rows = cur.fetchall()
-            data = [dict(zip(columns, row)) for row in rows]
+        # Named (server-side) cursor streams rows in pages of itersize instead of
+        # buffering every trial of a popular drug client-side at once
+        with self._acquire() as conn:
+            with conn.cursor(name=f"trials_{uuid.uuid4().hex}", cursor_factory=RealDictCursor) as cur:
+                cur.itersize = 1000
+                cur.execute(query, (f"%{indication_name.lower()}%", f"%{drug_name.lower()}%"))
+                data = [dict(row) for row in cur]
+            # Named cursors run inside a transaction; end it before the connection goes back
+            conn.rollback()
         return data
\ No newline at end of file
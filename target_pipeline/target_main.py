@@ -8,9 +8,12 @@ Main pipeline for extracting drug and indication information for a user-specifie
 """
 
 import chembl_data_target
-import pandas as pd
+import csv
 import logging
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from target_db_client import TargetDBClient
 
 logging.basicConfig(
@@ -18,6 +21,101 @@ logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(message)s"
 )
 
+# Drugs processed in parallel; each one is a chain of I/O-bound ChEMBL and DB calls
+DRUG_WORKERS = 8
+
+OUTPUT_COLUMNS = [
+    "Target Symbol", "Drug Name", "MoA", "Indication", "Approval Status", "Modality",
+    "nct_id", "phase", "overall_status", "sponsor", "source_class", "official_title", "intervention_types",
+]
+
+def build_drug_rows(drug, target_input, db_client, modality, moa_targets):
+    """
+    Builds the output rows for one drug acting on the target: one row per
+    drug-indication-trial, or a single row with empty trial columns if nothing matched.
+    modality and moa_targets (the drug's mechanisms on the target) are pre-fetched
+    for all drugs in batched ChEMBL requests.
+    """
+    results = []
+    chembl_id = drug["molecule_chembl_id"]
+    drug_name = drug.get("pref_name") or chembl_id
+    moa_short = chembl_data_target.get_moa_short(moa_targets)
+    indications = chembl_data_target.get_indications_for_drug(chembl_id)
+    if not indications:
+        # Still output row for drug with NA indication
+        results.append({
+            "Target Symbol": target_input,
+            "Drug Name": drug_name,
+            "MoA": moa_short,
+            "Indication": "NA",
+            "Approval Status": "NA",
+            "Modality": modality,
+            "nct_id": "",
+            "phase": "",
+            "overall_status": "",
+            "sponsor": "",
+            "source_class": "",
+            "official_title": "",
+            "intervention_types": ""
+        })
+    else:
+        for ind in indications:
+            approval = chembl_data_target.get_approval_status_from_indication(ind)
+            # Fetch all trials for this drug-indication pair (already one row per nct_id)
+            all_trials = db_client.fetch_trials_for_drug_and_indication(drug_name, ind.get("indication_name", ""))
+
+            if not all_trials:
+                # Try all synonyms if no trials found with preferred name; different
+                # synonyms can match the same trial, so merge on nct_id
+                seen_nct_ids = set()
+                drug_synonyms = chembl_data_target.get_drug_synonyms(chembl_id)
+                for drug_syn in drug_synonyms:
+                    if drug_syn.lower() == (drug_name or "").lower():
+                        continue  # already tried preferred name
+                    syn_trials = db_client.fetch_trials_for_drug_and_indication(drug_syn, ind.get("indication_name", ""))
+                    if syn_trials:
+                        for trial in syn_trials:
+                            nct_id = trial.get("nct_id")
+                            if nct_id and nct_id not in seen_nct_ids:
+                                all_trials.append(trial)
+                                seen_nct_ids.add(nct_id)
+
+            if not all_trials:
+                # If no trial for any synonym, still output the row
+                results.append({
+                    "Target Symbol": target_input,
+                    "Drug Name": drug_name,
+                    "MoA": moa_short,
+                    "Indication": ind.get("indication_name", "NA"),
+                    "Approval Status": approval,
+                    "Modality": modality,
+                    "nct_id": "",
+                    "phase": "",
+                    "overall_status": "",
+                    "sponsor": "",
+                    "source_class": "",
+                    "official_title": "",
+                    "intervention_types": ""
+                })
+            else:
+                for trial in all_trials:
+                    results.append({
+                        "Target Symbol": target_input,
+                        "Drug Name": drug_name,
+                        "MoA": moa_short,
+                        "Indication": ind.get("indication_name", "NA"),
+                        "Approval Status": approval,
+                        "Modality": modality,
+                        "nct_id": trial.get("nct_id", ""),
+                        "phase": trial.get("phase", ""),
+                        "overall_status": trial.get("overall_status", ""),
+                        "sponsor": trial.get("sponsor", ""),
+                        "source_class": trial.get("source_class", ""),
+                        "official_title": trial.get("official_title", ""),
+                        "intervention_types": trial.get("intervention_types", "")
+                    })
+    return results
+
 def main():
     import argparse
     parser = argparse.ArgumentParser()
@@ -44,101 +142,46 @@ def main():
 
     logging.info(f"Found {len(drugs)} drugs for target {target_chembl_id}")
 
+    # Modality and MoA for every drug, in a handful of batched requests
+    chembl_ids = [drug["molecule_chembl_id"] for drug in drugs]
+    modalities = chembl_data_target.fetch_molecule_types(chembl_ids)
+    moa_by_drug = {}
+    for mt in chembl_data_target.fetch_moa_targets_for_ids(chembl_ids, filter_target=target_chembl_id):
+        moa_by_drug.setdefault(mt[0], []).append(mt)
+
     # Initialize DB client
     db_client = TargetDBClient()
 
-    # For each drug, get indications, MoA, modality, approval status, and trial info
-    results = []
-    for drug in drugs:
-        chembl_id = drug["molecule_chembl_id"]
-        drug_name = drug.get("pref_name") or chembl_id
-        modality = chembl_data_target.fetch_molecule_type(chembl_id)
-        moa_targets = chembl_data_target.fetch_moa_targets_for_ids([chembl_id], filter_target=target_chembl_id)
-        moa_short = chembl_data_target.get_moa_short(moa_targets)
-        indications = chembl_data_target.get_indications_for_drug(chembl_id)
-        if not indications:
-            # Still output row for drug with NA indication
-            results.append({
-                "Target Symbol": target_input,
-                "Drug Name": drug_name,
-                "MoA": moa_short,
-                "Indication": "NA",
-                "Approval Status": "NA",
-                "Modality": modality,
-                "nct_id": "",
-                "phase": "",
-                "overall_status": "",
-                "sponsor": "",
-                "source_class": "",
-                "official_title": "",
-                "intervention_types": ""
-            })
-        else:
-            for ind in indications:
-                approval = chembl_data_target.get_approval_status_from_indication(ind)
-                # Fetch all trials for this drug-indication pair
-                trials = db_client.fetch_trials_for_drug_and_indication(drug_name, ind.get("indication_name", ""))
-                all_trials = []
-                seen_nct_ids = set()
+    def drug_rows(drug):
+        return build_drug_rows(
+            drug, target_input, db_client,
+            modalities.get(drug["molecule_chembl_id"], "NA"),
+            moa_by_drug.get(drug["molecule_chembl_id"], []),
+        )
 
-                if trials:
-                    for trial in trials:
-                        nct_id = trial.get("nct_id")
-                        if nct_id and nct_id not in seen_nct_ids:
-                            all_trials.append(trial)
-                            seen_nct_ids.add(nct_id)
-                else:
-                    # Try all synonyms if no trials found with preferred name
-                    drug_synonyms = chembl_data_target.get_drug_synonyms(chembl_id)
-                    for drug_syn in drug_synonyms:
-                        if drug_syn.lower() == (drug_name or "").lower():
-                            continue  # already tried preferred name
-                        syn_trials = db_client.fetch_trials_for_drug_and_indication(drug_syn, ind.get("indication_name", ""))
-                        if syn_trials:
-                            for trial in syn_trials:
-                                nct_id = trial.get("nct_id")
-                                if nct_id and nct_id not in seen_nct_ids:
-                                    all_trials.append(trial)
-                                    seen_nct_ids.add(nct_id)
-
-                if not all_trials:
-                    # If no trial for any synonym, still output the row
-                    results.append({
-                        "Target Symbol": target_input,
-                        "Drug Name": drug_name,
-                        "MoA": moa_short,
-                        "Indication": ind.get("indication_name", "NA"),
-                        "Approval Status": approval,
-                        "Modality": modality,
-                        "nct_id": "",
-                        "phase": "",
-                        "overall_status": "",
-                        "sponsor": "",
-                        "source_class": "",
-                        "official_title": "",
-                        "intervention_types": ""
-                    })
-                else:
-                    for trial in all_trials:
-                        results.append({
-                            "Target Symbol": target_input,
-                            "Drug Name": drug_name,
-                            "MoA": moa_short,
-                            "Indication": ind.get("indication_name", "NA"),
-                            "Approval Status": approval,
-                            "Modality": modality,
-                            "nct_id": trial.get("nct_id", ""),
-                            "phase": trial.get("phase", ""),
-                            "overall_status": trial.get("overall_status", ""),
-                            "sponsor": trial.get("sponsor", ""),
-                            "source_class": trial.get("source_class", ""),
-                            "official_title": trial.get("official_title", ""),
-                            "intervention_types": trial.get("intervention_types", "")
-                        })
-
-    df = pd.DataFrame(results)
-    df.to_csv(args.output, index=False)
-    logging.info(f"Saved {len(df)} rows to {args.output}")
+    # For each drug, get indications, MoA, modality, approval status, and trial info.
+    # Drugs are processed concurrently but written in drug order, as soon as each is
+    # done, so partial output is visible during long runs. At most 2 * DRUG_WORKERS
+    # drugs are in flight, so a slow drug holds back a bounded number of finished results.
+    n_rows = 0
+    drug_iter = iter(drugs)
+    with open(args.output, "w", newline="") as f, ThreadPoolExecutor(max_workers=DRUG_WORKERS) as ex:
+        writer = csv.DictWriter(f, fieldnames=OUTPUT_COLUMNS)
+        writer.writeheader()
+        pending = deque((drug, ex.submit(drug_rows, drug)) for drug in islice(drug_iter, 2 * DRUG_WORKERS))
+        idx = 0
+        while pending:
+            drug, future = pending.popleft()
+            rows = future.result()
+            # Top the window back up before writing, so the workers stay busy
+            for next_drug in islice(drug_iter, 1):
+                pending.append((next_drug, ex.submit(drug_rows, next_drug)))
+            writer.writerows(rows)
+            f.flush()
+            n_rows += len(rows)
+            idx += 1
+            logging.info(f"Processed drug {idx}/{len(drugs)}: {drug.get('pref_name') or drug['molecule_chembl_id']} ({len(rows)} rows)")
+    logging.info(f"Saved {n_rows} rows to {args.output}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file